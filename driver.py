@@ -24,6 +24,7 @@
 # SOFTWARE.
 ###########################################################################
 import sys
+import logging
 import warnings
 import argparse
 import yaml
@@ -47,6 +48,10 @@ parser.add_argument('-p', '--params', help='Params file.', required=True)
 parser.add_argument('-o', '--output', help='Output HDF5 file.', required=True)
 args = parser.parse_args()
 
+# model components report progress at INFO level.  raise this to WARNING to
+# quiet them when running large ensembles.
+logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+
 def main():
   # load parameter file from disk as YAML file to dictionary
   with open(args.params) as f:
@@ -87,123 +92,128 @@ def main():
 
     # create a tracker to record model data over the run
     model_state.tracker = S.Tracker(model_state, model_params['model']['setup']['n_animals'])
-    if model_state.tracker.check_redundant_run(paramfile_string, seed, args.output):
+    if not model_state.tracker.open_archive(paramfile_string, seed, args.output):
       print(f"redundant seed: skipping")
       continue
 
-    # distribute mean_ndvi to all cells
-    for id in model_state.gis.mean_ndvi_alltime:
-      idx = model_state.world.id_to_index[id]
-      cellobj = model_state.world.grid[idx][1]
-      cellobj.mean_ndvi_alltime = model_state.gis.mean_ndvi_alltime[id]
+    # the archive is open from here on: always close it, even if the run
+    # fails, so the file is not left open with an incomplete seed group.
+    try:
+      # distribute mean_ndvi to all cells
+      for id in model_state.gis.mean_ndvi_alltime:
+        idx = model_state.world.id_to_index[id]
+        cellobj = model_state.world.cell_objs[idx]
+        cellobj.mean_ndvi_alltime = model_state.gis.mean_ndvi_alltime[id]
 
-    ###### Create initial events
+      ###### Create initial events
     
-    ## load up all of the timestep events
-    events = time.enumerate_step_events(t_end)
-    for (event_time, event_type) in events:
-      eq.add_event(event_time, event_type)
-      eq.add_event(event_time, E.Event.INFECTION)
-
-    ## set up monthly GIS updates
-    update_times = time.enumerate_month_starts(t_start, t_end)
+      ## load up all of the timestep events
+      events = time.enumerate_step_events(t_end)
+      for (event_time, event_type) in events:
+        eq.add_event(event_time, event_type)
+        eq.add_event(event_time, E.Event.INFECTION)
+
+      ## set up monthly GIS updates
+      update_times = time.enumerate_month_starts(t_start, t_end)
     
-    # add start date - it is excluded from the enumeration in case
-    # it doesn't fall at the start of a month.
-    update_times.append(t_start)
-    for event_time in update_times:
-      eq.add_event(event_time, E.Event.GISUPDATE)
-
-    ## set up periodic vaccinations
-    for month_day in model_params['agents']['vaccination_schedule']:
-      vaccine_times = time.enumerate_annual_events(month_day[0], month_day[1], t_end)
-      for event_time in vaccine_times:
-        eq.add_event(event_time, E.Event.VACCINATE)
-
-    ###### Main loop
-    current_event = eq.next_event()
-    while current_event is not None:
-      #print(time.current_time)
-      (event_time, event_type, subject) = current_event
-
-      # move time forward in the time tracker
-      time.set_time(event_time)
-
-      if event_type == E.Event.GISUPDATE:
-        # update GIS data
-        model_state.world.update_gis(model_params, event_time)
-
-      elif event_type == E.Event.MOVEMENT:
-        # handle a movement event for one agent
-        subject.handle_event(time, event_type)
-
-      elif event_type == E.Event.LIV_BIRTH:
-        subject.handle_event(time, event_type)
-
-      elif event_type == E.Event.LIV_FERTILE:
-        subject.handle_event(time, event_type)
-
-      elif event_type == E.Event.WORLDSTEP:
-        ## TODO: should only step world and herd health.  not breeding and decisions
-        # step the world forward
-        model_state.world.step(model_params, time)
-
-      elif event_type == E.Event.AGENTSTEP:
-        # step the heads of household forward
-        hoh.step(time)
-
-        # step the herdsmen forward
-        hmen.step(time)
-
-        # record statistics about the agents and the world
-        hmen.record(time)
-        hoh.record(time)
-
-      elif event_type == E.Event.VACCINATE:
-        # head of household disease decisions
-        hoh.handle_event(time, event_type)
-
-      elif event_type == E.Event.CULL_OLDAGE:
-        # event corresponding to a single animal expiring due to old age.
-        if subject.active:
-          # Congratulations little cow, disease and malnutrition didn't get you.
-          model_state.tracker.record_death("age", time.day_of_epoch())
-          subject.herd.cull(subject)
-
-      elif event_type == E.Event.WEAROFF:
-        # vaccination wearoff, V -> S transition.  only consider animals that 
-        # are still active in case the animal left the simulation for some other 
-        # cause before now.
-        (disease, animal) = subject
-        if animal.active:
-          animal.set_disease_state(disease, D.SIRV.S)
-
-      elif event_type == E.Event.INFECTION:
-        # TODO: currently only allows one infection per event.  may explore allowing
-        #       more than one infection
-        # TODO: currently does not use GIS data (e.g., water sources) to add spatial
-        #       factors in likelihood of infection.  fine for now, but may add later.
-
-        # randomly infect an animal
-        for d in diseases:
-          # sample the disease to see if an infection event occurs right now.
-          infect = diseases[d].sample_infection(time)
-          if infect:
-            # if an infection event occurs, pick a herd at random and
-            # an animal in the herd at random.
-            herd = hmen.get(rand.randint(hmen.size())).herd
-            if herd.size() > 0:
-              animal = herd.animals[rand.randint(herd.size())]
-              animal.set_disease_state(d, D.SIRV.I)
-
-      else:
-        print("Unsupported event: "+str(current_event))
-        sys.exit()
-
-      # pop next event
+      # add start date - it is excluded from the enumeration in case
+      # it doesn't fall at the start of a month.
+      update_times.append(t_start)
+      for event_time in update_times:
+        eq.add_event(event_time, E.Event.GISUPDATE)
+
+      ## set up periodic vaccinations
+      for month_day in model_params['agents']['vaccination_schedule']:
+        vaccine_times = time.enumerate_annual_events(month_day[0], month_day[1], t_end)
+        for event_time in vaccine_times:
+          eq.add_event(event_time, E.Event.VACCINATE)
+
+      ###### Main loop
       current_event = eq.next_event()
-
-    model_state.tracker.to_archive(paramfile_string, seed, args.output)
+      while current_event is not None:
+        #print(time.current_time)
+        (event_time, event_type, subject) = current_event
+
+        # move time forward in the time tracker
+        time.set_time(event_time)
+
+        if event_type == E.Event.GISUPDATE:
+          # update GIS data
+          model_state.world.update_gis(model_params, event_time)
+
+        elif event_type == E.Event.MOVEMENT:
+          # handle a movement event for one agent
+          subject.handle_event(time, event_type)
+
+        elif event_type == E.Event.LIV_BIRTH:
+          subject.handle_event(time, event_type)
+
+        elif event_type == E.Event.LIV_FERTILE:
+          subject.handle_event(time, event_type)
+
+        elif event_type == E.Event.WORLDSTEP:
+          ## TODO: should only step world and herd health.  not breeding and decisions
+          # step the world forward
+          model_state.world.step(model_params, time)
+
+        elif event_type == E.Event.AGENTSTEP:
+          # step the heads of household forward
+          hoh.step(time)
+
+          # step the herdsmen forward
+          hmen.step(time)
+
+          # record statistics about the agents and the world
+          hmen.record(time)
+          hoh.record(time)
+
+        elif event_type == E.Event.VACCINATE:
+          # head of household disease decisions
+          hoh.handle_event(time, event_type)
+
+        elif event_type == E.Event.CULL_OLDAGE:
+          # event corresponding to a single animal expiring due to old age.
+          if subject.active:
+            # Congratulations little cow, disease and malnutrition didn't get you.
+            model_state.tracker.record_death("age", time.day_of_epoch())
+            subject.herd.cull(subject)
+
+        elif event_type == E.Event.WEAROFF:
+          # vaccination wearoff, V -> S transition.  only consider animals that 
+          # are still active in case the animal left the simulation for some other 
+          # cause before now.
+          (disease, animal) = subject
+          if animal.active:
+            animal.set_disease_state(disease, D.SIRV.S)
+
+        elif event_type == E.Event.INFECTION:
+          # TODO: currently only allows one infection per event.  may explore allowing
+          #       more than one infection
+          # TODO: currently does not use GIS data (e.g., water sources) to add spatial
+          #       factors in likelihood of infection.  fine for now, but may add later.
+
+          # randomly infect an animal
+          for d in diseases:
+            # sample the disease to see if an infection event occurs right now.
+            infect = diseases[d].sample_infection(time)
+            if infect:
+              # if an infection event occurs, pick a herd at random and
+              # an animal in the herd at random.
+              herd = hmen.get(rand.randint(hmen.size())).herd
+              if herd.size() > 0:
+                animal = herd.animals[rand.randint(herd.size())]
+                animal.set_disease_state(d, D.SIRV.I)
+
+        else:
+          print("Unsupported event: "+str(current_event))
+          sys.exit()
+
+        # pop next event
+        current_event = eq.next_event()
+
+      model_state.tracker.close_archive()
+    finally:
+      model_state.tracker.release_archive()
 
 # run block of code and catch warnings
 with warnings.catch_warnings():
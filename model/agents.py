@@ -126,6 +126,10 @@ class Person:
 
         # Adopt a unique identifier
         self.id = gen_id()
+
+        # Flag for herd-owning agents, so the world can track them
+        # without type checks.
+        self.is_herdsman = False
     # }}} 
 
     # {{{ get_world_cell
@@ -134,7 +138,7 @@ class Person:
             where they reside. """
         if self.location is None:
             return None
-        return self.model_state.world.grid[self.location][1]
+        return self.model_state.world.cell_objs[self.location]
     # }}}
 
     # {{{ get_world_cell_by_id
@@ -142,14 +146,14 @@ class Person:
         """ Return the cell object from the world corresponding
             to a specific GIS cell ID. """
         idx = self.model_state.world.id_to_index[cell_id]
-        return self.model_state.world.grid[idx][1]
+        return self.model_state.world.cell_objs[idx]
     # }}}
 
     # {{{ get_world_cell_by_index
     def get_world_cell_by_index(self, idx):
         """ Return the cell object from the world corresponding
             to a given world grid index. """
-        return self.model_state.world.grid[idx][1]
+        return self.model_state.world.cell_objs[idx]
     # }}}
 
     # {{{ get_world_cell_by_latlon
@@ -157,7 +161,7 @@ class Person:
         """ Return the cell object from the world that is closest
             to the given latitude and longitude. """
         nearest = self.model_state.world.nearest_cell(latlon)
-        return self.model_state.world.grid[nearest][1]
+        return self.model_state.world.cell_objs[nearest]
     # }}}
 
     # {{{ handle_event
@@ -348,6 +352,8 @@ class Herdsman(Person):
         self.next_waypoint = None
         self.latlon = None
         self.direction = None
+
+        self.is_herdsman = True
     # }}}
 
     # {{{ setters
@@ -82,7 +82,7 @@ def initialize_objects(model_params, model_state, individual_params):
   for i in range(setup_params['height']):
     for j in range(setup_params['width']):
       id_to_index[cell_ids[i,j]] = (i,j)
-      (_,cell_obj) = w.grid[i,j]
+      cell_obj = w.cell_objs[i,j]
       cell_obj.cell_id = cell_ids[i,j]
       cell_obj.longitude = cell_lon[i,j]
       cell_obj.latitude = cell_lat[i,j]
@@ -90,19 +90,17 @@ def initialize_objects(model_params, model_state, individual_params):
   # determine whether the first dimension of the grid index corresponds
   # to latitude or longitude by checking the first element of the first
   # and second columns.
-  w.first_dim_lat = False
+  first_dim_lat = False
   if cell_lat[0,0] == cell_lat[0,1]:
-    w.first_dim_lat = True
+    first_dim_lat = True
 
-  if not w.first_dim_lat:
-    w.lat_boundaries = boundaries(cell_lat[0,:])
-    w.lon_boundaries = boundaries(cell_lon[:,0])
+  if not first_dim_lat:
+    w.set_cell_boundaries(first_dim_lat, boundaries(cell_lat[0,:]), boundaries(cell_lon[:,0]))
   else:
-    w.lat_boundaries = boundaries(cell_lat[:,0])
-    w.lon_boundaries = boundaries(cell_lon[0,:])
+    w.set_cell_boundaries(first_dim_lat, boundaries(cell_lat[:,0]), boundaries(cell_lon[0,:]))
 
   # store ID->index map in world for later use when loading monthly data
-  w.id_to_index = id_to_index
+  w.set_id_to_index(id_to_index)
 
   # read static location data
   village_table = gis.villages
@@ -127,7 +125,7 @@ def initialize_objects(model_params, model_state, individual_params):
     logmsg(f"Creating village at {pos}")
 
     # need to copy gridspace attributes before replacing the object.
-    (_, cell_obj) = w.grid[pos]
+    cell_obj = w.cell_objs[pos]
 
     v.latitude = cell_obj.latitude
     v.longitude = cell_obj.longitude
@@ -142,7 +140,7 @@ def initialize_objects(model_params, model_state, individual_params):
     #print(w.id_to_index[i])
 
   for pos in positions:
-    (_,cellobj) = w.grid[pos]
+    cellobj = w.cell_objs[pos]
     cellobj.has_water = True
 
   # create social network : two people per household - the HoH and the herdsman
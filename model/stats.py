@@ -24,29 +24,91 @@
 # SOFTWARE.
 ###########################################################################
 import os.path
+import logging
 import numpy as np
-import matplotlib.pyplot as plt
 import h5py
 import model.disease as D
 
+logger = logging.getLogger(__name__)
+
+# seed group attribute written by close_archive once all of a run's data is
+# in the archive.
+COMPLETE_MARKER = 'total_animals'
+
+# layout version of the archive, stored as an attribute of the params group.
+# version 2 stores the per-seed totals as seed group attributes and streams
+# time series into resizable datasets; files without the attribute use the
+# original layout.
+ARCHIVE_FORMAT = 2
+
 class IncompatibleParameters(Exception):
   pass
 
+class IncompatibleFormat(Exception):
+  pass
+
+class SeriesWriter:
+  """
+  Buffered appender for a resizable HDF5 dataset.  Rows are collected in a
+  fixed size buffer and written to the dataset a block at a time so that the
+  cost of resizing the dataset is amortized over many rows, and memory use is
+  bounded by the block size instead of the length of the run.
+  """
+  def __init__(self, grp, name, row_shape, dtype, block=1024):
+    self.buffer = np.zeros((block,) + row_shape, dtype=dtype)
+    self.count = 0
+    self.dset = grp.create_dataset(name, shape=(0,) + row_shape,
+                                   maxshape=(None,) + row_shape,
+                                   chunks=(block,) + row_shape,
+                                   dtype=dtype, compression='lzf')
+
+  def append(self, row):
+    """ Add a row, flushing the buffer to disk if it is full. """
+    self.buffer[self.count] = row
+    self.count += 1
+    if self.count == self.buffer.shape[0]:
+      self.flush()
+
+  def flush(self):
+    """ Write all buffered rows to the end of the dataset and flush the
+        file to disk. """
+    if self.count == 0:
+      return
+    n = self.dset.shape[0]
+    self.dset.resize(n + self.count, axis=0)
+    self.dset[n:] = self.buffer[:self.count]
+    self.count = 0
+
+    # the archive stays open for the whole run, so flush the file after
+    # each block to keep the on-disk metadata consistent if the run is
+    # killed before the archive is closed.
+    self.dset.file.flush()
+
 class Tracker:
   """ 
-  Tracker class to record results of model as it runs.  This class uses a
-  DataArchive class to record the results of a run to disk.
+  Tracker class to record results of model as it runs.  Time series are
+  streamed to the archive file as the run progresses, so open_archive must
+  be called before any time series are recorded and close_archive at the end
+  of the run to write the remaining summary data.
   """
   def __init__(self, model_state, initial_animal_count):
     self.model_state = model_state
     self.occupants = []
-    self.occupant_totals = np.zeros((model_state.world.height, model_state.world.width))
+    self.occupant_totals = np.zeros((model_state.world.height, model_state.world.width), dtype=np.float32)
+
+    self.diseases = list(model_state.diseases)
+    self._disease_index = {d: i for i, d in enumerate(self.diseases)}
+
+    # archive file and streamed time series, created by open_archive
+    self.archive = None
+    self.seed_group = None
     self.vaccine_decisions = {}
-    self.vaccinated = {}
+    self.vaccinated = None
+    self.herdsize = None
+    self.avg_health = None
+    self.avg_ages = None
+
     self.deaths = {}
-    self.herdsize = []
-    self.avg_health = []
-    self.avg_ages = []
     self.disease_breakdown = []
     self.total_animals = initial_animal_count
     self.total_distance = 0.0
@@ -69,10 +131,7 @@ class Tracker:
     """
     Record the decision value for a given disease at some time.
     """
-    if disease in self.vaccine_decisions:
-      self.vaccine_decisions[disease].append((decision, time))
-    else:
-      self.vaccine_decisions[disease] = [(decision, time)]
+    self.vaccine_decisions[disease].append((time, decision))
 
   def record_death(self, cause, time):
     """
@@ -86,51 +145,75 @@ class Tracker:
 
   def record_herd(self, herd, time):
     day_of_epoch = time.day_of_epoch()
-    self.herdsize.append((herd.size(), day_of_epoch))
-    healths = [a.health for a in herd.animals]
-    ages = [a.age(time) for a in herd.animals]
-
-    for disease in self.model_state.diseases:
-      count = sum([1 for a in herd.animals if a.diseases[disease] == D.SIRV.V])
-      if disease in self.vaccinated:
-        self.vaccinated[disease].append((count, herd.size(), day_of_epoch))
-      else:
-        self.vaccinated[disease] = [(count, herd.size(), day_of_epoch)]
-    self.avg_health.append((np.average(np.array(healths)), day_of_epoch))
-    self.avg_ages.append((np.average(np.array(ages)), day_of_epoch))
-
-  def check_redundant_run(self, param_string, seed, filename):
-    """ Check if we are trying to do a run for a seed that has already
-        been run.  If the parameters do not match, fatal error since we have
-        chosen an incompatible output file that already has data from a different
-        parameter set. """
-    if os.path.isfile(filename):
-      f = h5py.File(filename, 'r')
 
-      # check if param string matches
-      f_pstr = f['params']['yaml'][()]
-      if param_string != f_pstr:
-        print("FATAL ERROR: parameter string does not match output file.")
-        f.close()
-        raise IncompatibleParameters
+    # accumulate health, age, and vaccinated counts in a single pass over
+    # the animals in the herd.
+    hsum = 0.0
+    asum = 0.0
+    n = 0
+    vcounts = [0] * len(self.diseases)
+    didx = self._disease_index.items()
+    V = D.SIRV.V
+    for a in herd.animals:
+      hsum += a.health
+      asum += a.age(time)
+      n += 1
+      ad = a.diseases
+      for disease, i in didx:
+        if ad[disease] == V:
+          vcounts[i] += 1
 
-      if str(seed) in f:
-        return True
+    self.herdsize.append((day_of_epoch, n))
+
+    row = np.empty((len(self.diseases), 3), dtype=np.int32)
+    row[:, 0] = day_of_epoch
+    row[:, 1] = n
+    row[:, 2] = vcounts
+    self.vaccinated.append(row)
+
+    # empty herds have no meaningful average
+    if n > 0:
+      self.avg_health.append((day_of_epoch, hsum / n))
+      self.avg_ages.append((day_of_epoch, asum / n))
     else:
-      return False
+      self.avg_health.append((day_of_epoch, np.nan))
+      self.avg_ages.append((day_of_epoch, np.nan))
 
-  def to_archive(self, param_string, seed, filename):
-    """ Emit the stats object to an archive file.  The seed is required to distinguish
-        runs within an ensemble from the same base parameter set. """
+  def open_archive(self, param_string, seed, filename):
+    """ Open the archive file and create the group for this seed along with
+        the resizable datasets that time series are streamed into.  The seed is
+        required to distinguish runs within an ensemble from the same base
+        parameter set.
+
+        Returns False without modifying the file if the seed has already been
+        run to completion; an incomplete group for the seed is replaced.  If
+        the parameters or archive format do not match those of an existing
+        file, this is a fatal error since we have chosen an incompatible
+        output file that already has data in it. """
     if os.path.isfile(filename):
       f = h5py.File(filename, 'r+')
 
-      # check if param string matches
-      f_pstr = f['params']['yaml'][()]
+      # seeds in one file must share a layout for the reporter to read them
+      if f['params'].attrs.get('format') != ARCHIVE_FORMAT:
+        f.close()
+        raise IncompatibleFormat("output file was written with a different archive format.")
+
+      # check if param string matches.  h5py returns stored strings as bytes,
+      # so read the dataset back as str for the comparison.
+      f_pstr = f['params']['yaml'].asstr()[()]
       if param_string != f_pstr:
-        print("FATAL ERROR: parameter string does not match output file.")
         f.close()
-        exit()
+        raise IncompatibleParameters("parameter string does not match output file.")
+
+      if str(seed) in f:
+        if COMPLETE_MARKER in f[str(seed)].attrs:
+          f.close()
+          return False
+
+        # a group without the marker is left over from a run that did not
+        # finish: discard it and run the seed again.
+        logger.info("discarding incomplete seed %s", seed)
+        del f[str(seed)]
 
       seed_group = f.create_group(str(seed))
     else:
@@ -139,12 +222,43 @@ class Tracker:
       # archive parameters and seed
       grp = f.create_group('params')
       grp.create_dataset('yaml', data=param_string)
+      grp.attrs['format'] = ARCHIVE_FORMAT
       seed_group = f.create_group(str(seed))
 
-    # record scalar counts for animals and distance
-    print(f'd={self.total_distance}  n={self.total_animals}')
-    seed_group.create_dataset('total_distance', data=self.total_distance)
-    seed_group.create_dataset('total_animals', data=self.total_animals)
+    self.archive = f
+    self.seed_group = seed_group
+
+    ## time series data, each row led by the day of the epoch
+    # vaccine decisions
+    grp = seed_group.create_group('vaccination')
+    for disease in self.diseases:
+      self.vaccine_decisions[disease] = SeriesWriter(grp, disease, (2,), np.float64)
+
+    # vaccinated counts: one [record, disease, (day, herd size, count)] array
+    # for all diseases, with the disease names giving the second axis order.
+    grp = seed_group.create_group('vaccinated')
+    self.vaccinated = SeriesWriter(grp, 'counts', (len(self.diseases), 3), np.int32)
+    grp.create_dataset('diseases', data=np.array(self.diseases, dtype='S16'))
+
+    # livestock
+    grp = seed_group.create_group('livestock')
+    self.herdsize = SeriesWriter(grp, 'herdsize', (2,), np.int64)
+    self.avg_health = SeriesWriter(grp, 'avg_health', (2,), np.float64)
+    self.avg_ages = SeriesWriter(grp, 'avg_age', (2,), np.float64)
+
+    # write the new seed group's metadata to disk before the run starts
+    f.flush()
+    return True
+
+  def close_archive(self):
+    """ Flush the streamed time series, write the summary data for the run,
+        and close the archive file. """
+    seed_group = self.seed_group
+
+    for series in self.vaccine_decisions.values():
+      series.flush()
+    for series in (self.vaccinated, self.herdsize, self.avg_health, self.avg_ages):
+      series.flush()
 
     # store GIS data to translate cell IDs to latlon
     grp = seed_group.create_group('gis')
@@ -154,31 +268,19 @@ class Tracker:
 
     for i in range(self.model_state.world.height):
       for j in range(self.model_state.world.width):
-        (_, cell_obj) = self.model_state.world.grid[i, j]
+        cell_obj = self.model_state.world.cell_objs[i, j]
         dset_id[i, j] = cell_obj.cell_id
         dset_lat[i, j] = cell_obj.latitude
         dset_lon[i, j] = cell_obj.longitude
 
     # store cell occupancy statistics
+    # chunked and compressed: most cells are never occupied, so the bulk of
+    # the array is zero and compresses away.
     grp = seed_group.create_group('world')
-    grp.create_dataset('occupancy', data=self.occupant_totals)
-
-    ## store time series data
-    # vaccine decisions
-    grp = seed_group.create_group('vaccination')
-    for disease in self.vaccine_decisions:
-      grp.create_dataset(disease, data=np.fliplr(np.array(self.vaccine_decisions[disease])))
-
-    # vaccinated counts
-    grp = seed_group.create_group('vaccinated')
-    for disease in self.vaccinated:
-      grp.create_dataset(disease, data=np.fliplr(np.array(self.vaccinated[disease])))
-
-    # livestock
-    grp = seed_group.create_group('livestock')
-    grp.create_dataset('herdsize', data=np.fliplr(np.array(self.herdsize)))
-    grp.create_dataset('avg_health', data=np.fliplr(np.array(self.avg_health)))
-    grp.create_dataset('avg_age', data=np.fliplr(np.array(self.avg_ages)))
+    (h, w) = self.occupant_totals.shape
+    grp.create_dataset('occupancy', data=self.occupant_totals,
+                       chunks=(min(256, h), min(256, w)), compression='lzf',
+                       shuffle=True, fillvalue=0.0)
 
     # deaths
     grp = seed_group.create_group('deaths')
@@ -187,4 +289,20 @@ class Tracker:
       for (i, t) in enumerate(self.deaths[cause]):
         dset_cause[i, 0] = t
 
-    f.close()
+    # record scalar counts for animals and distance as attributes of the
+    # seed group: these are stored inline in the group header.  they are
+    # written last, so total_animals also marks the seed group as complete.
+    logger.info("d=%s  n=%s", self.total_distance, self.total_animals)
+    seed_group.attrs['total_distance'] = float(self.total_distance)
+    seed_group.attrs[COMPLETE_MARKER] = int(self.total_animals)
+
+    self.release_archive()
+
+  def release_archive(self):
+    """ Close the archive file if it is open.  If close_archive has not been
+        called, the seed group is left without its completion marker and is
+        recreated by the next open_archive for that seed. """
+    if self.archive is not None:
+      self.archive.close()
+    self.archive = None
+    self.seed_group = None
@@ -27,6 +27,7 @@
 Time modeling.  Mapping of current time to calendar date, step sizes.
 """
 import datetime as D
+import functools
 import dateutil.relativedelta as RD
 import numpy as np
 import numpy.random as rand
@@ -71,6 +72,10 @@ class Time:
     self.stepsize = stepsize
     self.last_timestep = None
 
+    # day number since the start of the epoch, maintained as time advances
+    # so that day_of_epoch() queries for the current time are cheap.
+    self._day = 0
+
   def current_step_duration(self):
     """ Return the current time step as the number of days from
         the current time to the last timestep.  If no last timestep,
@@ -135,14 +140,13 @@ class Time:
       raise TimeOrderViolation((time, self.current_time))
 
     self.current_time = time
+    self._day = (self.current_time - self.initial_date).days
 
   def day_of_epoch(self, time=None):
     """ Return the day number since the start of the epoch (day 0). """
     if time is None:
-      delta = self.current_time - self.initial_date
-    else:
-      delta = time - self.initial_date
-    return delta.days
+      return self._day
+    return (time - self.initial_date).days
 
   def step_size_days(self):
     """ Return the current step size in days. """
@@ -151,7 +155,13 @@ class Time:
   def steps_for_timedelta(self, period):
     """ Return the number of steps in a given time period,
         rounding up. """
-    return int(np.ceil(period.days / self.stepsize.days))
+    return Time._steps_for_days(period.days, self.stepsize.days)
+
+  @staticmethod
+  @functools.lru_cache(maxsize=128)
+  def _steps_for_days(period_days, stepsize_days):
+    """ Memoized helper for steps_for_timedelta keyed on day counts. """
+    return int(np.ceil(period_days / stepsize_days))
 
   def day_of_year(self):
     """ Return the day of year for the current time. """
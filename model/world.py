@@ -27,7 +27,81 @@ import sys
 import math
 import geopy.distance
 import numpy as np
-import model.agents as A
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# area of cell : 1km^2 = 1000*1000 m^2
+CELL_AREA = 1e6
+
+# {{{ cell boundary helpers
+def uniform_inverse_spacing(boundaries):
+    """
+    If a sorted array of cell boundaries is evenly spaced, return the inverse
+    of the spacing.  Otherwise return None.
+    """
+    spacing = np.diff(boundaries)
+    if len(spacing) > 0 and np.all(np.abs(spacing - spacing[0]) <= 1e-12 * abs(spacing[0])):
+        return 1.0 / spacing[0]
+    return None
+
+def boundary_index(x, boundaries, inv_spacing):
+    """
+    Return the index of the cell delimited by boundaries that contains x,
+    clamped to the first and last cells.  inv_spacing is the inverse of the
+    boundary spacing if it is uniform, or None.
+    """
+    if inv_spacing is not None:
+        idx = math.floor((x - boundaries[0]) * inv_spacing)
+    else:
+        idx = int(np.searchsorted(boundaries, x, side='right')) - 1
+    return min(max(idx, 0), len(boundaries) - 2)
+# }}}
+
+# {{{ array_by_id
+def array_by_id(values):
+    """
+    Convert a dictionary from integer cell ID to value into a dense array
+    indexed by cell ID.  IDs that are not present map to NaN.
+    """
+    ids = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+    result = np.full(ids.max() + 1, np.nan)
+    result[ids] = np.fromiter(values.values(), dtype=np.float64, count=len(values))
+    return result
+
+def lookup_by_id(table, ids):
+    """
+    Gather the values for an array of cell IDs from a dense array built by
+    array_by_id.  Raises KeyError for an ID that has no value, as a lookup in
+    the original dictionary would.
+    """
+    in_range = (ids >= 0) & (ids < table.shape[0])
+    if not in_range.all():
+        raise KeyError(int(ids[~in_range][0]))
+    values = table[ids]
+    missing = np.isnan(values)
+    if missing.any():
+        raise KeyError(int(ids[missing][0]))
+    return values
+# }}}
+
+# {{{ distribute_food
+def distribute_food(sizes, dt, eat, forage_capacity):
+    """
+    Forage a cell for a set of co-located herds with the given sizes over
+    the time period dt and return the food units each herd receives, in
+    proportion to its size.  forage_capacity is the number of animal-days
+    of food the cell supports (see World.forage_capacity).  Sizes must sum
+    to a positive number.  This is compiled with numba when it is available.
+    """
+    n = sizes.sum()
+    frac_avail = min(forage_capacity / (n * dt), 1.0)
+    return sizes * (eat * dt * frac_avail)
+
+if numba is not None:
+    distribute_food = numba.njit(cache=True)(distribute_food)
+# }}}
 
 # {{{ path
 class Path:
@@ -36,7 +110,11 @@ class Path:
     originates and terminates at a specific cell ID.
     """
     def __init__(self, waypoints):
-        self.waypoints = waypoints
+        self.waypoints = np.asarray(waypoints, dtype=np.int32)
+
+        # index of the step following each step.  the path is a cycle, so the
+        # last step is followed by the first.
+        self._next = np.roll(np.arange(len(self.waypoints), dtype=np.int32), -1)
 
     def nextstep(self, stepid):
         """
@@ -45,9 +123,16 @@ class Path:
         path is a cycle, so when we hit the end of the path assume that
         we've returned to the beginning.
         """
-        if stepid == len(self.waypoints)-1:
-            return (0, self.waypoints[0])
-        return (stepid+1, self.waypoints[stepid+1])
+        n = self._next[stepid]
+        return (int(n), int(self.waypoints[n]))
+
+    def nextstep_many(self, stepids):
+        """
+        Vectorized nextstep: given an array of steps, return arrays of the
+        next step numbers and their cell IDs.
+        """
+        n = self._next[stepids]
+        return (n, self.waypoints[n])
 # }}}
 
 # {{{ grid space
@@ -59,24 +144,37 @@ class GridSpace:
     # {{{ constructor
     def __init__(self, params):
         # NDVI ranges from -1.0 to 1.0
-        self.mean_ndvi = 0.0
         self.mean_ndvi_alltime = 0.0
 
         self.params = params
         self.location = None
 
+        # world that the cell belongs to.  monthly GIS values for the cell are
+        # stored in arrays held by the world and indexed by location.
+        self.world = None
+
         self.has_water = False
+    # }}}
 
-        self.veg_capacity = None
+    # {{{ GIS values
+    @property
+    def mean_ndvi(self):
+        return self.world.ndvi[self.location]
+
+    @property
+    def mean_precip(self):
+        return self.world.precip[self.location]
+
+    @property
+    def veg_capacity(self):
+        return self.world.veg_capacity[self.location]
     # }}}
 
     # {{{ forage
     def forage(self, num_animals, dt):
         # units of livestock.eat : m^2
-        # area of cell : 1km^2 = 1000*1000 m^2
-        cell_area = 1e6
         food_required = num_animals * self.params['livestock']['eat'] * dt
-        frac_avail = min((cell_area * self.veg_capacity)/food_required, 1.0)
+        frac_avail = min(self.world.forage_capacity[self.location]/(num_animals * dt), 1.0)
         food_obtained = food_required * frac_avail
         return food_obtained
     # }}}
@@ -155,36 +253,132 @@ class World:
         # GIS data store
         self.gis = model_state.gis
 
-        # grid cell is a pair:
-        # - a list of agents residing there
+        # each grid cell has:
         # - a grid cell object
-        self.grid = np.empty((h, w), dtype=object)
-        
+        # - a list of agents residing there
+        # - the subset of those agents that are herdsmen
+        self.cell_objs = np.empty((h, w), dtype=object)
+        self.residents = np.empty((h, w), dtype=object)
+        self.herd_residents = np.empty((h, w), dtype=object)
+
         for i in range(h):
             for j in range(w):
-                self.grid[i, j] = ([], d((i, j)))
-                self.grid[i, j][1].location = (i, j)
+                self.cell_objs[i, j] = d((i, j))
+                self.cell_objs[i, j].location = (i, j)
+                self.cell_objs[i, j].world = self
+                self.residents[i, j] = []
+                self.herd_residents[i, j] = []
+
+        # monthly GIS values for each cell
+        self.ndvi = np.zeros((h, w))
+        self.precip = np.zeros((h, w))
+        self.world_mean_ndvi = 0.0
 
-        # diseases are propagated by the world, so we must track them
+        # vegetation capacity for each cell.  undefined until the first FCI
+        # update.
+        self.veg_capacity = np.full((h, w), np.nan)
+
+        # animal-days of food each cell supports given its vegetation
+        # capacity: cell area * veg_capacity / livestock.eat.  updated with
+        # the vegetation capacity.
+        self.forage_capacity = np.full((h, w), np.nan)
+
+        # diseases are propagated by the world, so we must track them.  the
+        # bound step methods are cached for the world step loop.
         self.diseases = {}
+        self._disease_steps = ()
 
-        # GIS related state variables
+        # GIS related state variables.  the ID to index map is also kept as a
+        # pair of dense row/column arrays indexed by cell ID.
         self.id_to_index = {}
+        self._id_row = None
+        self._id_col = None
         self.mean_fci = None
         self.neighbor_cache = {}
+        self._offset_tables = {}
+        self._offset_lists = {}
+
+        # (h, w) arrays of GIS cell IDs and of the average FCI of each cell.
+        # both are built on the first vegetation update.
+        self._cell_ids = None
+        self._fci_averages = None
 
         # extra fields to help with efficient nearest cell lookup
         self.first_dim_lat = False
         self.lat_boundaries = None
         self.lon_boundaries = None
 
-        self.live_cells = None
+        # boundaries and inverse spacings in grid index order, along with the
+        # position of the matching coordinate in a (lat, lon) pair.
+        self._dim_boundaries = None
+        self._dim_inv_spacing = None
+        self._dim_coord = None
+
+        # occupancy bitmap of cells that contain at least one agent.  this is
+        # maintained by place_agent() and move().
+        self.occupied = np.zeros((h, w), dtype=bool)
+
+        # scratch buffer of herd sizes for co-located herds, reused across
+        # cells and steps.
+        self._herd_sizes = np.zeros(16, dtype=np.int32)
+
+        # date of the most recent GIS update.  GIS data is monthly, so updates
+        # within the same month are skipped.
+        self.last_gis_update = None
+    # }}}
+
+    # {{{ set_id_to_index
+    def set_id_to_index(self, id_to_index):
+        """ Set the map from GIS cell ID to (i,j) grid index. """
+        self.id_to_index = id_to_index
+        max_id = max(id_to_index.keys())
+        self._id_row = np.full(max_id + 1, -1, dtype=np.int32)
+        self._id_col = np.full(max_id + 1, -1, dtype=np.int32)
+        for (cell_id, (i, j)) in id_to_index.items():
+            self._id_row[cell_id] = i
+            self._id_col[cell_id] = j
+    # }}}
+
+    # {{{ grid_indices
+    def grid_indices(self, ids):
+        """ Return the (rows, cols) grid index arrays for an array of GIS cell
+            IDs.  Raises KeyError for an ID that is not in the grid. """
+        in_range = (ids >= 0) & (ids < self._id_row.shape[0])
+        if not in_range.all():
+            raise KeyError(int(ids[~in_range][0]))
+        rows = self._id_row[ids]
+        cols = self._id_col[ids]
+        unknown = rows < 0
+        if unknown.any():
+            raise KeyError(int(ids[unknown][0]))
+        return (rows, cols)
+    # }}}
+
+    # {{{ set_cell_boundaries
+    def set_cell_boundaries(self, first_dim_lat, lat_boundaries, lon_boundaries):
+        """ Set the latitude and longitude cell boundaries used by nearest_cell.
+            first_dim_lat indicates whether the first grid index corresponds to
+            latitude.  If the boundaries are evenly spaced the cell index is
+            computed directly instead of searched for. """
+        self.first_dim_lat = first_dim_lat
+        self.lat_boundaries = np.ascontiguousarray(lat_boundaries, dtype=np.float64)
+        self.lon_boundaries = np.ascontiguousarray(lon_boundaries, dtype=np.float64)
+
+        # order the boundaries by grid dimension so that nearest_cell does not
+        # need to check which dimension is latitude on every query.
+        if first_dim_lat:
+            self._dim_boundaries = (self.lat_boundaries, self.lon_boundaries)
+            self._dim_coord = (0, 1)
+        else:
+            self._dim_boundaries = (self.lon_boundaries, self.lat_boundaries)
+            self._dim_coord = (1, 0)
+        self._dim_inv_spacing = tuple(uniform_inverse_spacing(b) for b in self._dim_boundaries)
     # }}}
 
     # {{{ nearest_cell
     def nearest_cell(self, latlon):
-        """ Find the nearest cell to a given latitude and longitude
-            by bisection search.  Two assumptions:
+        """ Find the nearest cell to a given latitude and longitude.  Two
+            assumptions:
 
             - Latitude and longitude increase as their respective cell indices
               increase.  (e.g., cell[i,j] < cell[i,j] w.r.t. lat or lon).
@@ -192,45 +386,30 @@ class World:
               remains fixed.  This restricts us to grids aligned with the latitude/longitude
               lines.
 
-            Bisection search for an m by n grid will require O(log n) + O(log m) time, versus
-            the O(n * m) time required for brute force search through all cells.  This
-            results in a substantial speedup.
+            For evenly spaced boundaries the index is computed in O(1) time, otherwise
+            a binary search over the boundaries takes O(log n) + O(log m) time for an
+            m by n grid, versus the O(n * m) time required for brute force search
+            through all cells.
         """
-        (lat, lon) = latlon
-        # first find lat cell coordinate
-        n = len(self.lat_boundaries)
-        lo = 0
-        hi = n-1
-        lat_idx = n//2
-        while hi-lo > 1:
-            if lat < self.lat_boundaries[lat_idx]:
-                hi = lat_idx
-            else:
-                lo = lat_idx
-            lat_idx = (hi-lo)//2 + lo
-
-        # then find lon cell coordinate
-        n = len(self.lon_boundaries)
-        lo = 0
-        hi = n-1
-        lon_idx = n//2
-        while hi-lo > 1:
-            if lon < self.lon_boundaries[lon_idx]:
-                hi = lon_idx
-            else:
-                lo = lon_idx
-            lon_idx = (hi-lo)//2 + lo
-
-        if self.first_dim_lat:
-            return (lat_idx, lon_idx)
-        else:
-            return (lon_idx, lat_idx)
+        (b0, b1) = self._dim_boundaries
+        (s0, s1) = self._dim_inv_spacing
+        (c0, c1) = self._dim_coord
+        return (boundary_index(latlon[c0], b0, s0),
+                boundary_index(latlon[c1], b1, s1))
     # }}}
 
     # {{{ add_disease
     def add_disease(self, disease):
         """ Add a disease to the set that the world steps. """
         self.diseases[disease.name] = disease
+        self._disease_steps = tuple(d.step for d in self.diseases.values())
+    # }}}
+
+    # {{{ remove_disease
+    def remove_disease(self, name):
+        """ Remove a disease from the set that the world steps. """
+        del self.diseases[name]
+        self._disease_steps = tuple(d.step for d in self.diseases.values())
     # }}}
 
     # {{{ set_cell
@@ -241,8 +420,11 @@ class World:
         The location attribute of the cell object is set to the
         position.
         """
-        self.grid[position] = ([], cell_obj)
-        self.grid[position][1].location = position
+        self.cell_objs[position] = cell_obj
+        self.residents[position] = []
+        self.herd_residents[position] = []
+        cell_obj.location = position
+        cell_obj.world = self
     # }}}
 
     # {{{ move
@@ -255,50 +437,83 @@ class World:
         old_position = agent.location
 
         # remove agent from current location resident set
-        (residents, _) = self.grid[old_position]
+        residents = self.residents[old_position]
         residents.remove(agent)
         if len(residents) == 0:
-            self.live_cells.remove(old_position)
+            self.occupied[old_position] = False
+        if agent.is_herdsman:
+            self.herd_residents[old_position].remove(agent)
 
         # add agent to new location resident set
-        (residents, _) = self.grid[position]
+        residents = self.residents[position]
         residents.append(agent)
-        if position not in self.live_cells:
-            self.live_cells.add(position)
+        self.occupied[position] = True
+        if agent.is_herdsman:
+            self.herd_residents[position].append(agent)
 
         # set agent location to new coordinates
         agent.location = position
     # }}}
         
+    # {{{ neighborhood_offsets
+    def neighborhood_offsets(self, r):
+        """
+        Return a table of (di, dj, dist) offsets for all cells within the
+        radius r of a cell, excluding the cell itself.  Tables are built once
+        per radius and reused.
+        """
+        if r not in self._offset_tables:
+            # compare squared distances and only take the square root of the
+            # offsets that are kept.
+            k = int(r)
+            r2 = r * r
+            offsets = [(di, dj, math.sqrt(di*di + dj*dj))
+                       for di in range(-k, k+1) for dj in range(-k, k+1)
+                       if 0 < di*di + dj*dj <= r2]
+            self._offset_lists[r] = offsets
+            self._offset_tables[r] = np.array(offsets, dtype=[('di', np.int32),
+                                                              ('dj', np.int32),
+                                                              ('dist', np.float64)])
+        return self._offset_tables[r]
+    # }}}
+
     # {{{ neighborhood
     def neighborhood(self, position, r):
         """
         Find coordinates for all cells around position that are within
         the radius r.  Return a list of (coordinate, distance) pairs.
+
+        Cells at least r away from the edge of the world all have the same
+        neighborhood up to a shift, so it is built directly from the offset
+        table.  Only neighborhoods clipped by the edge are cached.
         """
-        if position not in self.neighbor_cache:
-            neighbors = []
-            for i in np.arange(max(0, position[0]-r), min(self.height, position[0]+r)):
-                for j in np.arange(max(0, position[1]-r), min(self.width, position[1]+r)):
-                    # ignore (i,j) == pos
-                    if (i != position[0]) or (j != position[1]):
-                        d = math.hypot(position[0]-i, position[1]-j)
-                        #d = U.dist(pos, (i,j))
-                        if d <= r:
-                            neighbors.append(((int(i), int(j)), d))
-            self.neighbor_cache[position] = neighbors
+        offsets = self.neighborhood_offsets(r)
+        (pi, pj) = position
+        k = int(r)
+        if k <= pi < self.height - k and k <= pj < self.width - k:
+            return [((pi + di, pj + dj), d) for (di, dj, d) in self._offset_lists[r]]
+
+        key = (position, r)
+        if key not in self.neighbor_cache:
+            i = pi + offsets['di']
+            j = pj + offsets['dj']
+            mask = (i >= 0) & (i < self.height) & (j >= 0) & (j < self.width)
+            neighbors = [((int(ni), int(nj)), float(d))
+                         for (ni, nj, d) in zip(i[mask], j[mask], offsets['dist'][mask])]
+            self.neighbor_cache[key] = neighbors
         else:
-            neighbors = self.neighbor_cache[position]
+            neighbors = self.neighbor_cache[key]
         return neighbors
     # }}}
 
     # {{{ place_agent
     def place_agent(self, agent, position):
-        """ Place an agent at a position.  This is only used during initialization
-            and does not update the live cell set. """
+        """ Place an agent at a position.  This is only used during initialization. """
         agent.location = position
-        (residents, _) = self.grid[position]
-        residents.append(agent)
+        self.residents[position].append(agent)
+        self.occupied[position] = True
+        if agent.is_herdsman:
+            self.herd_residents[position].append(agent)
     # }}}
 
     # {{{ update_vegetation
@@ -308,27 +523,39 @@ class World:
 
         # map GIS data onto cells, calculate mean NDVI for this time period over
         # the world.
-        self.world_mean_ndvi = 0.0
-        for cell_id in gis_data:
-            row = gis_data[cell_id]
-            self.grid[self.id_to_index[cell_id]][1].mean_ndvi = row['mean_ndvi']
-            self.world_mean_ndvi += row['mean_ndvi']
-            self.grid[self.id_to_index[cell_id]][1].mean_precip = row['mean_precip']
-        self.world_mean_ndvi = self.world_mean_ndvi / (self.width * self.height)
+        cell_ids = list(gis_data)
+        n = len(cell_ids)
+        ids = np.fromiter(cell_ids, dtype=np.int64, count=n)
+        (rows, cols) = self.grid_indices(ids)
+        ndvi = np.fromiter((gis_data[cell_id]['mean_ndvi'] for cell_id in cell_ids),
+                           dtype=np.float64, count=n)
+        self.ndvi[rows, cols] = ndvi
+        self.precip[rows, cols] = np.fromiter((gis_data[cell_id]['mean_precip'] for cell_id in cell_ids),
+                                              dtype=np.float64, count=n)
+        self.world_mean_ndvi = ndvi.sum() / (self.width * self.height)
 
         # get FCI for current month and update veg_capacity
         fci_data = self.gis.get_fci_month(date.year, date.month)
         if fci_data is not None:
-            for i in np.arange(self.height):
-                for j in np.arange(self.width):
-                    cellobj = self.grid[i, j][1]
-                    cellobj.veg_capacity = fci_data[cellobj.cell_id] / self.gis.grid_fci_averages[cellobj.cell_id]
+            if self._cell_ids is None:
+                self._cell_ids = np.array([[self.cell_objs[i, j].cell_id for j in range(self.width)]
+                                           for i in range(self.height)], dtype=np.int64)
+                self._fci_averages = lookup_by_id(array_by_id(self.gis.grid_fci_averages),
+                                                  self._cell_ids)
+            fci = lookup_by_id(array_by_id(fci_data), self._cell_ids)
+            self.veg_capacity[:] = fci / self._fci_averages
+            self.forage_capacity[:] = self.veg_capacity * (CELL_AREA / params['livestock']['eat'])
     # }}}
 
     # {{{ update_gis
     def update_gis(self, params, date):
-        """ Update all GIS-driven state for the given date and parameter set. """
-        self.update_vegetation(params, date)
+        """ Update all GIS-driven state for the given date and parameter set.
+            Nothing is recomputed if the month has not changed since the last
+            update. """
+        last = self.last_gis_update
+        if last is None or date.month != last.month or date.year != last.year:
+            self.update_vegetation(params, date)
+            self.last_gis_update = date
     # }}}
 
     def step(self, params, time):
@@ -342,54 +569,41 @@ class World:
             exit()
             return
 
-        # if the live cell set has not yet been created, populate it via a traversal
-        # of the world.  after this initial creation it is maintained by the move()
-        # function.
-        # TODO: possibly handle this in place_agent if we know that agents are ONLY
-        #       ever placed in the grid by either place_agent or move calls.
-        if self.live_cells is None:
-            self.live_cells = set([])
-            for i in np.arange(self.height):
-                for j in np.arange(self.width):
-                    (agents, _) = self.grid[i, j]
-                    if len(agents) > 0:
-                        self.live_cells.add((i, j))
-
-        for (i, j) in self.live_cells:
-            # get the agents in each cell and the cell object
-            (agents, cell_obj) = self.grid[i, j]
+        eat = params['livestock']['eat']
+        disease_steps = self._disease_steps
 
+        # materialize the occupied cells as row and column index lists once
+        # rather than iterating over rows of an argwhere array.
+        (rows, cols) = np.nonzero(self.occupied)
+        for (i, j) in zip(rows.tolist(), cols.tolist()):
             # collect all of the herds colocated here
-            herds = []
-            for agent in agents:
-                if isinstance(agent, A.Herdsman):
-                    herds.append(agent.herd)
+            herds = [agent.herd for agent in self.herd_residents[i, j]]
 
             # if we have at least one herd here, eat and propagate diseases
             if len(herds) > 0:
-                n_animals = sum([herd.size() for herd in herds])
+                if len(herds) > len(self._herd_sizes):
+                    self._herd_sizes = np.zeros(2 * len(herds), dtype=np.int32)
+                sizes = self._herd_sizes[:len(herds)]
+                for (k, herd) in enumerate(herds):
+                    sizes[k] = herd.size()
 
                 # make sure we don't just have empty herds
-                if n_animals > 0:
-                    # foraging
-                    food_available = cell_obj.forage(n_animals, dt)
-                    for herd in herds:
-                        # distribute food proportionally
-                        frac_food = (herd.size()/n_animals) * food_available
-                        herd.feed(frac_food, dt)
+                if sizes.sum() > 0:
+                    # foraging: distribute food proportionally
+                    food = distribute_food(sizes, dt, eat, self.forage_capacity[i, j])
+                    for (herd, units) in zip(herds, food):
+                        herd.feed(units, dt)
 
                     # disease spread
-                    for d in self.diseases:
-                        self.diseases[d].step(herds, time)
+                    for disease_step in disease_steps:
+                        disease_step(herds, time)
 
         # Record the time now to calculate the duration of time until the
         # next step
         time.last_timestep = time.current_time
 
-    ### NOTE: this is equivalent to the code above except in the order by which
-    ###       cells with agents are visited due to the order that the set iterator
-    ###       traverses the set of live cells.  Keep this in mind when comparing the
-    ###       two.
+    ### NOTE: this is equivalent to the code above.  Both visit cells with agents
+    ###       in row-major order; the code above just skips the empty cells.
     def old_step(self, params, time):
         dt = time.current_step_duration()
 
@@ -401,27 +615,23 @@ class World:
         # iterate over all grid cells
         for i in np.arange(self.height):
             for j in np.arange(self.width):
-                # get the agents in each cell and the cell object
-                (agents, cell_obj) = self.grid[i, j]
-
-                # collect all of the herds colocated here
-                herds = []
-                for agent in agents:
-                    if isinstance(agent, A.Herdsman):
-                        herds.append(agent.herd)
+                # get the cell object and all of the herds colocated here
+                cell_obj = self.cell_objs[i, j]
+                herds = [agent.herd for agent in self.herd_residents[i, j]]
 
                 # if we have at least one herd here, eat and propagate diseases
                 if len(herds) > 0:
                     # feeding
-                    n_animals = sum([herd.size() for herd in herds])
+                    sizes = [herd.size() for herd in herds]
+                    n_animals = sum(sizes)
 
                     # make sure we don't just have empty herds
                     if n_animals > 0:
                         food_available = cell_obj.forage(n_animals, dt)
-                        for herd in herds:
+                        inv_n = 1.0 / n_animals
+                        for (herd, size) in zip(herds, sizes):
                             # distribute food proportionally
-                            frac_food = (herd.size()/n_animals) * food_available
-                            herd.feed(frac_food, dt)
+                            herd.feed(size * inv_n * food_available, dt)
 
                         # disease spread
                         for d in self.diseases:
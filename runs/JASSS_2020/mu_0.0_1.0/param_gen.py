@@ -1,9 +1,9 @@
 import argparse
 import yaml
 try:
-  from yaml import CLoader as Loader
+  from yaml import CLoader as Loader, CDumper as Dumper
 except ImportError:
-  from yaml import Loader
+  from yaml import Loader, Dumper
 
 ## command line
 parser = argparse.ArgumentParser(description="PastoralScape param generator")
@@ -21,8 +21,8 @@ def main():
         for mu in range(0,21):
           for d in model_params['ising']:
             model_params['ising'][d]['mu'] = max(0.0, min(1.0, mu * 0.05))
-            stream = open(f'params_{mu}.yaml', 'w')
-            yaml.dump(model_params, stream) 
+          with open(f'params_{mu}.yaml', 'w') as stream:
+            yaml.dump(model_params, stream, Dumper=Dumper)
           runscript += f"python3 ../../driver.py -p params_{mu}.yaml -o output_{mu}.yaml\n"
         print(runscript)
         
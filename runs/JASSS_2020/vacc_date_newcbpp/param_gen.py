@@ -1,9 +1,9 @@
 import argparse
 import yaml
 try:
-  from yaml import CLoader as Loader
+  from yaml import CLoader as Loader, CDumper as Dumper
 except ImportError:
-  from yaml import Loader
+  from yaml import Loader, Dumper
 
 ## command line
 parser = argparse.ArgumentParser(description="PastoralScape param generator")
@@ -18,8 +18,8 @@ def main():
 
         for mont in range(1,13):
           model_params['agents']['vaccination_schedule'] = [[mont,1]]
-          stream = open(f'params_{mont}.yaml', 'w')
-          yaml.dump(model_params, stream) 
+          with open(f'params_{mont}.yaml', 'w') as stream:
+            yaml.dump(model_params, stream, Dumper=Dumper)
         
     
 main()
@@ -24,10 +24,22 @@
 # SOFTWARE.
 ###########################################################################
 import argparse
+import csv
+import sys
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import h5py
 import numpy as np
 import yaml
-from yaml import Loader
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+try:
+    import numba
+except ImportError:
+    numba = None
 
 ## command line
 parser = argparse.ArgumentParser(description="PastoralScape Reporter")
@@ -36,14 +48,17 @@ parser.add_argument('-c', '--header', help='Print row of column headers.', actio
 parser.add_argument('-p', '--params', help='Parameters from config file to dump.  Colon separated dot paths (e.g.: ising.rvf.mu:ising.cbpp.mu).', required=True)
 args = parser.parse_args()
 
-f = h5py.File(args.input, 'r')
+# enlarge the chunk cache so that chunks shared by the many small per-seed
+# datasets stay resident while the seeds are read.
+f = h5py.File(args.input, 'r', rdcc_nbytes=64*1024*1024, rdcc_nslots=100003,
+              rdcc_w0=0.75)
 model_params = yaml.load(f['params']['yaml'][()], Loader=Loader)
 num_hoh = model_params['model']['setup']['n_hoh']
 num_herds = num_hoh
 
 seeds = list(f.keys())
 seeds.remove('params')
-seed_scale = 1.0 / len(seeds)
+n_seeds = len(seeds)
 
 columns = [
     'mean_tot_animals',
@@ -66,22 +81,142 @@ columns = [
 
 output = {}
 
+def flatten(d, prefix=''):
+    """ Yield (dotted path, value) pairs for every leaf of a nested dict. """
+    for (k, v) in d.items():
+        path = f'{prefix}{k}'
+        if isinstance(v, dict):
+            yield from flatten(v, path + '.')
+        else:
+            yield (path, v)
+
+flat_params = dict(flatten(model_params))
+
 params_include = args.params.split(':')
 for param in params_include:
-    d = model_params
-    for part in param.split('.'):
-        d = d[part]
     key = param.replace('.','_')
-    output[key] = d
+    output[key] = flat_params[param]
     columns.insert(0,key)
 
+#######################################################################
+## scratch buffers
+_scratch = threading.local()
+
+def scratch(dtype, n):
+    """ Return a per-thread scratch array of n elements.  The array is
+        overwritten by the next request for the same dtype on this thread. """
+    bufs = getattr(_scratch, 'bufs', None)
+    if bufs is None:
+        bufs = _scratch.bufs = {}
+    buf = bufs.get(dtype)
+    if buf is None or buf.shape[0] < n:
+        buf = bufs[dtype] = np.empty(max(n, 1024), dtype=dtype)
+    return buf[:n]
+
+def read_column(dset, col, dtype):
+    """ Read one column of a 2D dataset into a scratch array. """
+    n = dset.shape[0]
+    buf = scratch(dtype, n)
+    if n > 0:
+        dset.read_direct(buf, np.s_[:, col], np.s_[:n])
+    return buf
+
+#######################################################################
+## death counts
+CAUSES = ('age', 'health', 'rvf', 'cbpp')
+CAUSE_INDEX = {cause: i for (i, cause) in enumerate(CAUSES)}
+
+def report_deaths(g):
+    """ Return the number of deaths for each cause in CAUSES for a seed group
+        as an array ordered like CAUSES.  Each death is one row of its cause
+        dataset, so this only reads metadata.
+
+        Earlier versions of this script kept only one death day per week
+        when histogramming, undercounting deaths, so d_* columns from those
+        versions are lower than the ones reported here for the same file. """
+    totals = np.zeros(len(CAUSES), dtype=np.int64)
+    grp = g['deaths']
+    for cause in grp.keys():
+        ci = CAUSE_INDEX.get(cause)
+        if ci is not None:
+            totals[ci] = grp[cause].shape[0]
+    return totals
+
+#######################################################################
+## vaccination decisions
+def vacc_reduce(decisions, num_herds):
+    """ Mean over vaccination rounds of the sum of decisions across herds.
+        decisions holds num_herds consecutive values per round.  This is
+        compiled with numba when it is available. """
+    n = decisions.shape[0]
+    n_dec = n // num_herds
+    if n_dec * num_herds != n:
+        raise ValueError("vaccination decisions are not a whole number of rounds")
+    if n_dec == 0:
+        return np.nan
+    s = 0.0
+    for i in range(n_dec):
+        row = 0
+        base = i * num_herds
+        for j in range(num_herds):
+            row += decisions[base + j]
+        s += row
+    return s / n_dec
+
+if numba is not None:
+    # compiled without the GIL so that seeds in the thread pool reduce their
+    # decisions concurrently.
+    vacc_reduce = numba.njit(cache=True, nogil=True)(vacc_reduce)
+
+#######################################################################
+## per-seed aggregation
+def seed_total(g, name):
+    """ Read a per-seed total.  These are seed group attributes, or scalar
+        datasets in archives written before the attributes were used. """
+    if name in g.attrs:
+        return g.attrs[name]
+    return g[name][()]
+
+def process_seed(seed):
+    """ Reduce the data for one seed to its distance, animal count, deaths
+        per cause, and mean vaccination decision sum per disease. """
+    g = f[seed]
+    deaths = report_deaths(g)
+
+    vacc = {}
+    vgrp = g['vaccination']
+    for disease in vgrp.keys():
+        # only the decision column is needed, so read just that column.  the
+        # decisions are converted to int32 by HDF5 as they are read.
+        decisions=read_column(vgrp[disease], 1, np.int32)
+        vacc[disease] = vacc_reduce(decisions, num_herds)
+
+    return (seed_total(g, 'total_distance'), seed_total(g, 'total_animals'),
+            deaths, vacc)
+
+#######################################################################
+## combine seeds
+# seeds are independent, and most of the work is HDF5 decompression and
+# numpy reductions, so overlap seeds with a thread pool.  results are
+# combined in a single pass as they arrive.
+dists = np.empty(n_seeds)
+animals = np.empty(n_seeds)
+death_mat = np.zeros((n_seeds, len(CAUSES)))
+vacc_dec = {}
+
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    for (si, result) in enumerate(executor.map(process_seed, seeds)):
+        (dists[si], animals[si], death_mat[si], vacc) = result
+
+        for disease in vacc:
+            if disease not in vacc_dec:
+                vacc_dec[disease] = 0
+            vacc_dec[disease] += vacc[disease]
+
 #######################################################################
 ## movement and animal count
-tot_dist = 0.0
-tot_animal = 0.0
-for seed in seeds:
-    tot_dist += f[seed]['total_distance'][()] * seed_scale
-    tot_animal += f[seed]['total_animals'][()] * seed_scale
+tot_dist = dists.mean()
+tot_animal = animals.mean()
 
 output['mean_tot_animals'] = tot_animal
 output['mean_births'] = tot_animal - model_params['model']['setup']['n_animals']
@@ -90,64 +225,24 @@ output['mean_dist_herd'] = tot_dist / num_herds
 
 #######################################################################
 ## death counts
-def report_deaths(f, seed, maxday=4018):
-    causes = list(f[seed]['deaths'].keys())
-    
-    cumulative = {}
-    counts = {}
-    for cause in causes:
-        counts[cause] = np.zeros((1 + maxday//7,))
-    
-    for cause in causes:
-        dset=f[seed]['deaths'][cause]
-        (v, c) = np.unique(dset[:].transpose()[0], return_counts=True)
-        counts[cause][v.astype(int)//7] = c
-        cumulative[cause] = np.cumsum(counts[cause])
-        
-    return counts,cumulative
-
-death_stats = {}
-
-for seed in seeds:
-    counts, cumulative = report_deaths(f, seed)
-    for cause in counts:
-        if cause not in death_stats:
-            death_stats[cause] = []
-        death_stats[cause].append(np.sum(counts[cause]))
-
-causes = ['age', 'health', 'rvf', 'cbpp']
-for cause in causes:
-    if cause in death_stats:
-        output[f'd_{cause}_mean'] = np.mean(death_stats[cause])
-        output[f'd_{cause}_std'] = np.std(death_stats[cause])
-    else:
-        output[f'd_{cause}_mean'] = 0.0
-        output[f'd_{cause}_std'] = 0.0
+death_means = death_mat.mean(axis=0)
+death_stds = death_mat.std(axis=0)
+for (ci, cause) in enumerate(CAUSES):
+    output[f'd_{cause}_mean'] = death_means[ci]
+    output[f'd_{cause}_std'] = death_stds[ci]
 
 #######################################################################
 ## vaccination decision results
-vacc_dec = {}
-
-num_dec = 0
-
-for seed in seeds:
-    for disease in f[seed]['vaccination'].keys():
-        dset=f[seed]['vaccination'][disease][:].astype(int)
-        dnew=np.reshape(dset, (dset.shape[0]//num_herds,num_herds,2))
-        num_dec = dnew.shape[0]
-        if disease not in vacc_dec:
-            vacc_dec[disease] = 0
-
-        mean_d = np.mean([np.sum(dnew[i][:,1]) for i in range(dnew.shape[0])])
-        vacc_dec[disease] += mean_d * seed_scale
-
 for disease in vacc_dec:
-    d = vacc_dec[disease]
+    d = vacc_dec[disease] / n_seeds
     neg = (num_herds - d) / 2
     pos = num_herds - neg
     output[f'v_{disease}_pos'] = pos
     output[f'v_{disease}_neg'] = neg
 
+# floats are written with a fixed number of significant digits
+writer = csv.writer(sys.stdout, lineterminator='\n')
 if args.header:
-    print(','.join(columns))
-print(','.join([str(output[c]) for c in columns]))
+    writer.writerow(columns)
+writer.writerow([f'{output[c]:.6g}' if isinstance(output[c], float) else output[c]
+                 for c in columns])